@@ -61,21 +61,39 @@ import os
 import time
 import subprocess
 import getpass
+import shutil
 import argparse
 import re
 import logging
 from logging import StreamHandler
 import textwrap
+import socket
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import pexpect
+    from pexpect import fdpexpect
 except ImportError:
     sys.exit('The "pexpect" Python module is not installed. Please install it using pip or OS packaging.')
 
 
-# Telnet ports used to access IOS XE via socat
+# Serial tcpserver port used to access IOS XE
 CONSOLE_PORT = 65000
 
+# Largest single read from the console
+CONSOLE_MAXREAD = 65536
+
+# Limits for polling VirtualBox while the VM starts up and shuts down
+VM_POLL_TIMEOUT = 180
+VM_POLL_MIN_INTERVAL = 0.5
+VM_POLL_MAX_INTERVAL = 5
+
+# VirtualBox VM states in which a VM is stopped and needs no poweroff
+VM_STOPPED_STATES = ('poweroff', 'aborted', 'saved')
+
+# External tools the box build always shells out to
+REQUIRED_TOOLS = ('VBoxManage', 'VBoxHeadless', 'vagrant')
+
 # The background is set with 40 plus the number of the color,
 # and the foreground with 30.
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
@@ -95,6 +113,12 @@ class ColorHandler(StreamHandler):
         super(ColorHandler, self).__init__()
         self.colored = colored
 
+        # The escape sequences for each level never change, so build them
+        # once rather than for every record
+        self.prefixes = dict((level, self.colorPrefix(*attrs))
+                             for level, attrs in self.level_map.items())
+        self.default_prefix = self.colorPrefix(None, WHITE, False)
+
     COLORS = {
         'WARNING': YELLOW,
         'INFO': WHITE,
@@ -115,63 +139,63 @@ class ColorHandler(StreamHandler):
         logging.CRITICAL: (RED, WHITE, True),
     }
 
-    def addColor(self, text, bg, fg, bold):
+    def colorPrefix(self, bg, fg, bold):
         ctext = ''
         if bg is not None:
             ctext = self.COLOR_SEQ % (40 + bg)
         if bold:
             ctext = ctext + self.BOLD_SEQ
-        ctext = ctext + self.COLOR_SEQ % (30 + fg) + text + self.RESET_SEQ
-        return ctext
-
-    def colorize(self, record):
-        if record.levelno in self.level_map:
-            bg, fg, bold = self.level_map[record.levelno]
-        else:
-            bg, fg, bold = None, WHITE, False
-
-        # exception?
-        if record.exc_info:
-            formatter = logging.Formatter(format)
-            record.exc_text = self.addColor(
-                formatter.formatException(record.exc_info), bg, fg, bold)
-
-        record.msg = self.addColor(str(record.msg), bg, fg, bold)
-        return record
+        return ctext + self.COLOR_SEQ % (30 + fg)
 
     def format(self, record):
+        message = logging.StreamHandler.format(self, record)
         if self.colored:
-            message = logging.StreamHandler.format(self, self.colorize(record))
-        else:
-            message = logging.StreamHandler.format(self, record)
+            # Colour the finished line, leaving the record itself alone
+            prefix = self.prefixes.get(record.levelno, self.default_prefix)
+            message = prefix + message + self.RESET_SEQ
         return message
 
 
-def run(cmd, hide_error=False, cont_on_error=False):
+def run(cmd, hide_error=False, cont_on_error=False, capture=False):
     """
     Run command to execute CLI and catch errors and display them whether
     in verbose mode or not.
 
     Allow the ability to hide errors and also to continue on errors.
+
+    Stdout is only collected and returned when capture is True. Otherwise
+    it goes straight to our stdout when debug logging is enabled, so
+    progress from long commands shows as it happens, and to /dev/null
+    when it is not.
     """
 
     s_cmd = ' '.join(cmd)
     logger.info("'%s'", s_cmd)
 
+    if capture:
+        stdout = subprocess.PIPE
+    elif logger.isEnabledFor(logging.DEBUG):
+        stdout = None
+    else:
+        stdout = subprocess.DEVNULL
+
+    # Nothing run here reads stdin
     output = subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
+                              stdin=subprocess.DEVNULL,
+                              stdout=stdout,
                               stderr=subprocess.PIPE)
-    tup_output = output.communicate()
+    tup_output = [(out or b'').decode('utf-8', 'replace')
+                  for out in output.communicate()]
 
     if output.returncode != 0:
         logger.error('Failed (%d):', output.returncode)
     else:
         logger.debug('Succeeded (%d):', output.returncode)
 
-    logger.debug('Output [%s]' % tup_output[0])
+    logger.debug('Output [%s]', tup_output[0])
 
     if not hide_error and 0 != output.returncode:
-        logger.error('Error [%s]' % tup_output[1])
+        logger.error('Error [%s]', tup_output[1])
         if not cont_on_error:
             sys.exit('Quitting due to run command error')
         else:
@@ -181,29 +205,54 @@ def run(cmd, hide_error=False, cont_on_error=False):
     return tup_output[0]
 
 
+def get_vm_state(name):
+    """
+    Return the VirtualBox state of the given VM, or None if no VM of
+    that name is registered.
+    """
+
+    output = run(['VBoxManage', 'showvminfo', name, '--machinereadable'],
+                 hide_error=True, capture=True)
+    match = re.search(r'^VMState="(.*)"', output, re.MULTILINE)
+    if not match:
+        return None
+    return match.group(1)
+
+
 def cleanup_vmname(name, box_name):
     """
     Cleanup and unregister (delete) our working box.
     """
 
+    # One targeted query tells us both whether the VM is registered
+    # and whether it is running
+    state = get_vm_state(name)
+
     # Power off VM if it is running
-    vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-    if name in vms_list_running:
-        logger.debug("'%s' is running, powering off...", name)
+    if state is not None and state not in VM_STOPPED_STATES:
+        logger.debug("'%s' is %s, powering off...", name, state)
         run(['VBoxManage', 'controlvm', name, 'poweroff'])
 
     # Unregister and delete
-    vms_list = run(['VBoxManage', 'list', 'vms'])
-    if name in vms_list:
+    if state is not None:
         logger.debug("'%s' is registered, unregistering and deleting", name)
         run(['VBoxManage', 'unregistervm', box_name, '--delete'])
 
 
+def remove_file(path):
+    """Delete path if it exists, returning True if it did."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
 def pause_to_debug():
     logger.critical("Pause before debug")
     logger.critical(
         "Use: 'socat TCP:localhost:65000 -,raw,echo=0,escape=0x1d' to access the VM")
-    raw_input("Press Enter to continue.")
+    input("Press Enter to continue.")
     # To debug post box creation, add the following line to Vagrantfile
     # config.vm.provider "virtualbox" do |v|
     #   v.customize ["modifyvm", :id, "--uart1", "0x3F8", 4, "--uartmode1", 'tcpserver', 65000]
@@ -216,22 +265,45 @@ def start_process(args):
     """
 
     logger.debug('args: %s', args)
-    with open(os.devnull, 'w') as fp:
-        subprocess.Popen((args), stdout=fp)
-    time.sleep(2)
+    subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL)
+
+
+def wait_for_console(port, timeout=VM_POLL_TIMEOUT):
+    """
+    Wait for the VM's serial tcpserver port to accept connections.
+    VirtualBox only opens it once the VM is running, so this replaces
+    polling the VM state.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(('localhost', port),
+                                            VM_POLL_MIN_INTERVAL)
+        except socket.error:
+            if time.time() >= deadline:
+                sys.exit('VM console port %d still not listening after %d seconds'
+                         % (port, timeout))
+            time.sleep(VM_POLL_MIN_INTERVAL)
+        else:
+            sock.close()
+            return
 
 
 def configure_xe(verbose=False, wait=True):
     """
     Bring up XE and do some initial config.
-    Using socat to do the connection as telnet has an
-    odd double return on vbox
+    Talks to the serial tcpserver port directly over a socket, as telnet
+    has an odd double return on vbox
     """
 
     logger.warn('Waiting for IOS XE to boot (may take 3 minutes or so)')
     localhost = 'localhost'
 
-    PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+    # Compiled once, as it is matched after every command sent. It has to
+    # start a line, so that boot log text is not mistaken for it.
+    PROMPT = re.compile(r'\r?\n[\w-]+(\([\w-]+\))?[#>]')
     # don't want to rely on specific hostname
     # PROMPT = r'(Router|csr1kv).*[#>]'
     CRLF = "\r\n"
@@ -239,8 +311,10 @@ def configure_xe(verbose=False, wait=True):
     def send_line(line=CRLF):
         child.sendline(line)
         if line != CRLF:
-            logger.info('IOS Config: %s' % line)
-            child.expect(re.escape(line))
+            logger.info('IOS Config: %s', line)
+            # Every config line is different, so look for its echo as
+            # plain text rather than compiling a new regex each time
+            child.expect_exact(line)
 
     def send_cmd(cmd):
         if not isinstance(cmd, list):
@@ -249,24 +323,43 @@ def configure_xe(verbose=False, wait=True):
             send_line(c)
         child.expect(PROMPT)
 
+    child = None
+    console_log = None
     try:
-        child = pexpect.spawn("socat TCP:%s:%s -,raw,echo=0,escape=0x1d" % (localhost, CONSOLE_PORT))
+        sock = socket.create_connection((localhost, CONSOLE_PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # pexpect owns the socket from here on
+        child = fdpexpect.fdspawn(sock.detach(), maxread=CONSOLE_MAXREAD,
+                                  encoding='utf-8', codec_errors='replace')
 
+        # Keep a transcript of the console; it echoes what we send
         if verbose:
-            child.logfile = open("tmp.log", "w")
+            console_log = open("tmp.log", "w")
+            child.logfile_read = console_log
 
         # Long time for full configuration, waiting for ip address etc
         child.timeout = 600
 
         # wait for indication that boot has gone through
         if (wait):
-            child.expect(r'CRYPTO-6-GDOI_ON_OFF: GDOI is OFF', child.timeout)
+            # expect_exact only searches newly read console output
+            child.expect_exact('CRYPTO-6-GDOI_ON_OFF: GDOI is OFF',
+                               child.timeout)
+            # Consume the rest of the boot log read so far
+            try:
+                child.expect(re.compile('.+', re.DOTALL), timeout=1)
+            except pexpect.TIMEOUT:
+                pass
             logger.warn(
                 'Logging into Vagrant Virtualbox and configuring IOS XE')
 
+        # Wake the console up; only nudge it a second time if no prompt
+        # shows up, rather than always sleeping before the next CR
         send_line()
-        time.sleep(5)
-        send_line()
+        try:
+            child.expect(PROMPT, timeout=5)
+        except pexpect.TIMEOUT:
+            send_line()
         send_cmd("term width 300")
 
         # enable plus config mode
@@ -353,6 +446,46 @@ def configure_xe(verbose=False, wait=True):
     except pexpect.TIMEOUT:
         raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' % str(child.timeout))
 
+    finally:
+        if child is not None:
+            child.close()
+        if console_log is not None:
+            console_log.close()
+
+
+def check_required_tools(tools):
+    """
+    Exit with a clear message if any of the given tools is not in PATH.
+    """
+
+    missing = [tool for tool in tools if shutil.which(tool) is None]
+    if missing:
+        sys.exit('Required tools not found in PATH: %s' % ', '.join(missing))
+
+
+def fetch_remote_iso(uri):
+    """
+    Copy a remote [user@]server:/path ISO to the current directory and
+    return its local filename. rsync is used when installed, so that an
+    interrupted copy is resumed and an unchanged ISO is not copied again.
+    """
+
+    if '@' in uri.split(':', 1)[0]:
+        src = uri
+    else:
+        src = '%s@%s' % (getpass.getuser(), uri)
+    if shutil.which('rsync') is not None:
+        cmd = ['rsync', '--times', '--partial', '--inplace', '--progress',
+               src, '.']
+    else:
+        cmd = ['scp', src, '.']
+    logger.warn('Will attempt to %s the remote image to current working dir. You may be required to enter your password.', cmd[0])
+    logger.debug('%s\n', ' '.join(cmd))
+    # A partial ISO may be left behind, so check the exit status instead
+    if subprocess.call(cmd) != 0:
+        sys.exit('Failed to copy %s' % uri)
+    return os.path.basename(uri)
+
 
 def main(argv):
     input_iso = ''
@@ -387,7 +520,7 @@ def main(argv):
     parser.add_argument('-v', '--verbose',
                         action='store_const', const=logging.INFO,
                         default=logging.WARN, help='turn on verbose messages')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # setup logging
     root_logger = logging.getLogger()
@@ -398,22 +531,16 @@ def main(argv):
     root_logger.addHandler(handler)
     logger = logging.getLogger("box-builder")
 
-    # PRE-CHECK: is socat installed?
-    logger.warn('Check whether "socat" is installed')
-    try:
-        run(['socat', '-V'])
-    except OSError:
-        sys.exit(
-            'The "socat" utility is not installed. Please install it prior to using this script.')
+    # Fail fast, rather than part way through building the box
+    required_tools = list(REQUIRED_TOOLS)
+    if ':/' in args.ISO_FILE and shutil.which('rsync') is None:
+        required_tools.append('scp')
+    check_required_tools(required_tools)
 
     # Handle Input ISO (Local or URI)
-    if re.search(':/', args.ISO_FILE):
+    if ':/' in args.ISO_FILE:
         # URI Image
-        cmd_string = 'scp %s@%s .' % (getpass.getuser(), args.ISO_FILE)
-        logger.warn('Will attempt to scp the remote image to current working dir. You may be required to enter your password.')
-        logger.debug('%s\n', cmd_string)
-        subprocess.call(cmd_string, shell=True)
-        input_iso = os.path.basename(args.ISO_FILE)
+        input_iso = fetch_remote_iso(args.ISO_FILE)
     else:
         # Local image
         input_iso = args.ISO_FILE
@@ -433,8 +560,11 @@ def main(argv):
     ram = 4096
     logger.warn('Creating VirtualBox VM')
 
-    version = run(['VBoxManage', '-v'])
-    logger.info('Virtual Box Manager Version: %s', version)
+    # Probe the version and create the HDD while the VM is set up
+    executor = ThreadPoolExecutor(max_workers=2)
+    # The version is only reported in verbose mode
+    if logger.isEnabledFor(logging.INFO):
+        version = executor.submit(run, ['VBoxManage', '-v'], capture=True)
 
     # Set up paths
     base_dir = os.path.join(os.getcwd(), 'machines')
@@ -452,25 +582,29 @@ def main(argv):
     logger.debug('box_out:  %s', box_out)
     logger.debug('vbox:     %s', vbox)
 
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
-
-    if not os.path.exists(box_dir):
-        os.makedirs(box_dir)
+    # Creates base_dir as well, if needed
+    os.makedirs(box_dir, exist_ok=True)
 
     # Delete existing Box
-    if os.path.exists(box_out):
-        os.remove(box_out)
+    if remove_file(box_out):
         logger.debug('Found and deleted previous %s', box_out)
 
     # Delete existing OVA
-    if os.path.exists(ova_out) and args.create_ova is True:
-        os.remove(ova_out)
+    if args.create_ova is True and remove_file(ova_out):
         logger.debug('Found and deleted previous %s', ova_out)
 
     # Clean up existing vm's
     cleanup_vmname(vmname, vbox)
 
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('Virtual Box Manager Version: %s', version.result())
+
+    # Only once the old VM, and with it its disk, has been deleted
+    logger.debug('Create a HDD')
+    create_hdd = executor.submit(
+        run, ['VBoxManage', 'createmedium', 'disk', '--filename', vdi,
+              '--size', '8192', '--format', 'VDI', '--variant', 'Standard'])
+
     # Remove stale SSH entry
     # logger.debug('Removing stale SSH entries')
     # run(['ssh-keygen', '-R', '[localhost]:2222'])
@@ -484,15 +618,16 @@ def main(argv):
     logger.debug('Register VM')
     run(['VBoxManage', 'registervm', vbox])
 
-    # Setup memory, display, cpus etc
-    logger.debug('VRAM 4')
-    run(['VBoxManage', 'modifyvm', vmname, '--vram', '4'])
+    # Every VM setting below shares the same command prefix
+    modifyvm = ['VBoxManage', 'modifyvm', vmname]
 
-    logger.debug('Add ACPI')
-    run(['VBoxManage', 'modifyvm', vmname, '--memory', str(ram), '--acpi', 'on'])
+    # All the VM settings are applied with a single modifyvm, as each
+    # invocation rewrites the .vbox file
+    logger.debug('Configure VM: VRAM, memory, ACPI, NIC, serial ports, boot order')
 
-    # logger.debug('Add two CPUs')
-    # run(['VBoxManage', 'modifyvm', vmname, '--cpus', '2'])
+    # Setup memory, display, cpus etc
+    settings = ['--vram', '4', '--memory', str(ram), '--acpi', 'on']
+    # settings += ['--cpus', '2']
 
     # Setup networking - including ssh
     # it seems to be totally irrelevant how many interfaces are provisioned into
@@ -500,9 +635,8 @@ def main(argv):
     # if one wants more interfaces for individiual boxes then those have to be
     # added either in the vagrant file template or in the actual file inside the
     # box (after vagrant init).
-    logger.debug('Create NICs')
-    run(['VBoxManage', 'modifyvm', vmname, '--nic1', 'nat', '--nictype1', '82540EM'])
-    run(['VBoxManage', 'modifyvm', vmname, '--cableconnected1', 'on'])
+    settings += ['--nic1', 'nat', '--nictype1', '82540EM',
+                 '--cableconnected1', 'on']
 
     # Add Serial ports
     #
@@ -527,57 +661,45 @@ def main(argv):
 
     # Option 2: Connect via socat as telnet has double echo issue)
     # But can still use telnet in conjunction with socat
-    logger.debug('Add a console port')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart1', '0x3f8',
-         '4', '--uartmode1', 'tcpserver', str(CONSOLE_PORT)])
-
-    logger.debug('Add an aux port')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart2', '0x2f8',
-         '3', '--uartmode2', 'disconnected'])
+    # Console port, aux port
+    settings += ['--uart1', '0x3f8', '4', '--uartmode1', 'tcpserver', str(CONSOLE_PORT),
+                 '--uart2', '0x2f8', '3', '--uartmode2', 'disconnected']
 
     # Option 3: Connect via telnet
     # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 tcpserver 6000
     # VBoxManage modifyvm $VMNAME --uart2 0x2f8 3 --uartmode2 tcpserver 6001
 
-    # Setup storage
-    logger.debug('Create a HDD')
-    run(['VBoxManage', 'createhd', '--filename', vdi, '--size', '8192'])
+    # Change boot order to hd then dvd
+    settings += ['--boot1', 'disk', '--boot2', 'dvd']
 
+    run(modifyvm + settings)
+
+    # Setup storage
     logger.debug('Add IDE Controller')
     run(['VBoxManage', 'storagectl', vmname,
          '--name', 'IDE_Controller', '--add', 'ide'])
 
+    create_hdd.result()
+    executor.shutdown()
+
     logger.debug('Attach HDD')
     run(['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller',
          '--port', '0', '--device', '0', '--type', 'hdd', '--medium', vdi])
 
-    logger.debug('VM HD info: ')
-    run(['VBoxManage', 'showhdinfo', vdi])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('VM HD info: ')
+        run(['VBoxManage', 'showhdinfo', vdi])
 
     logger.debug('Add DVD drive')
     run(['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller',
          '--port', '1', '--device', '0', '--type', 'dvddrive', '--medium', input_iso])
 
-    # Change boot order to hd then dvd
-    logger.debug('Boot order disk first')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot1', 'disk'])
-
-    logger.debug('Boot order DVD second')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot2', 'dvd'])
-
     # Start the VM for installation of ISO - must be started as a sub process
     logger.warn('Starting VM...')
     start_process(['VBoxHeadless', '--startvm', vmname])
 
-    while True:
-        vms_list = run(['VBoxManage', 'showvminfo', vmname])
-        if 'running (since' in vms_list:
-            logger.warn('Successfully started to boot VM disk image')
-            break
-        else:
-            logger.warning('Failed to install VM disk image\n')
-            time.sleep(5)
-            continue
+    wait_for_console(CONSOLE_PORT)
+    logger.warn('Successfully started to boot VM disk image')
 
     # Configure IOS XE
     # do print steps for logging set to DEBUG and INFO
@@ -595,19 +717,23 @@ def main(argv):
     logger.warn('Waiting for machine to shutdown')
     run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
 
+    deadline = time.time() + VM_POLL_TIMEOUT
+    delay = VM_POLL_MIN_INTERVAL
     while True:
-        vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-        if vmname in vms_list_running:
-            logger.debug('Still shutting down')
-            continue
-        else:
+        state = get_vm_state(vmname)
+        if state is None or state in VM_STOPPED_STATES:
             logger.debug('Successfully shut down')
             break
+        elif time.time() < deadline:
+            logger.debug('Still shutting down')
+            time.sleep(delay)
+            delay = min(delay * 2, VM_POLL_MAX_INTERVAL)
+        else:
+            sys.exit('VM still not stopped after %d seconds' % VM_POLL_TIMEOUT)
 
     # Disable uart before exporting
     logger.debug('Remove serial uarts before exporting')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart1', 'off'])
-    run(['VBoxManage', 'modifyvm', vmname, '--uart2', 'off'])
+    run(modifyvm + ['--uart1', 'off', '--uart2', 'off'])
 
     # Shrink the VM
     logger.warn('Compact VDI')
@@ -629,8 +755,9 @@ def main(argv):
         run(['VBoxManage', 'export', vmname, '--output', ova_out])
         logger.debug('Created OVA %s', ova_out)
 
-    # Clean up VM used to generate box
-    cleanup_vmname(vmname, vbox)
+    # Clean up VM used to generate box. It is known to be registered and
+    # powered off by now, so there's no need to look up its state first.
+    run(['VBoxManage', 'unregistervm', vbox, '--delete'])
 
     logger.warn('Add box to system:')
     logger.warn('  vagrant box add --name iosxe %s --force', box_out)
@@ -63,21 +63,65 @@ import os
 import time
 import subprocess
 import getpass
+import shutil
 import argparse
 from argparse import RawDescriptionHelpFormatter
 import re
 import logging
 import pexpect
+from pexpect import fdpexpect
 import tarfile
+import base64
+import socket
+from concurrent.futures import ThreadPoolExecutor
 
-# Telnet ports used to access IOS XR via socat
+# Serial tcpserver ports used to access IOS XR
 CONSOLE_PORT = 65000
 AUX_PORT = 65001
 
+# Largest single read from the console
+CONSOLE_MAXREAD = 65536
+
+# External tools the box build always shells out to. main() adds the ones
+# that are only needed in some environments.
+REQUIRED_TOOLS = ('VBoxManage', 'VBoxHeadless', 'vagrant')
+
+# Where stale entries for the boxes' forwarded SSH ports are removed from
+KNOWN_HOSTS = os.path.expanduser('~/.ssh/known_hosts')
+
+# Support files shipped alongside this script, resolved once
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+EMBEDDED_VAGRANTFILE = os.path.join(SCRIPT_DIR, 'include', 'embedded_vagrantfile')
+METADATA_JSON = os.path.join(SCRIPT_DIR, 'metadata.json')
+
+# Vagrant insecure public key, installed so users can ssh without a password
+VAGRANT_PUBKEY = (
+    'ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eWW6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXPITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pzC6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZEnDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXzcWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ== '
+    'vagrant insecure public key\n')
+
+# VirtualBox VM states in which a VM is stopped and needs no poweroff
+VM_STOPPED_STATES = ('poweroff', 'aborted', 'saved')
+
 # General-purpose retry interval and timeout value (10 minutes)
 RETRY_INTERVAL = 5
 TIMEOUT = 600
 
+# The console port starts listening within a second or two of VBoxHeadless
+# starting, so poll for that more eagerly than RETRY_INTERVAL
+STARTUP_POLL_INTERVAL = 0.5
+
+# A poweroff normally completes within a second, so the shutdown poll
+# starts at SHUTDOWN_POLL_INTERVAL and doubles up to RETRY_INTERVAL
+SHUTDOWN_POLL_INTERVAL = 0.5
+
+# Output-polling XR CLI commands are retried every XR_CLI_POLL_INTERVAL
+# for up to XR_CLI_WAIT_TIMEOUT seconds
+XR_CLI_POLL_INTERVAL = 1
+XR_CLI_WAIT_TIMEOUT = 5 * RETRY_INTERVAL
+
+# How long to give XR to power itself off cleanly once asked to
+SHUTDOWN_TIMEOUT = 60
+
 logger = logging.getLogger(__name__)
 
 
@@ -93,38 +137,74 @@ class AbortScriptException(Exception):
     """Abort the script and clean up before exiting."""
 
 
-def run(cmd, hide_error=False, cont_on_error=False):
+def run(cmd, hide_error=False, cont_on_error=False, capture=False):
     '''
     Run command to execute CLI and catch errors and display them whether
     in verbose mode or not.
 
     Allow the ability to hide errors and also to continue on errors.
+
+    Stdout is only collected and returned (decoded to text) when capture
+    is True. Otherwise it goes straight to our stdout when debug logging
+    is enabled, so progress from long commands shows as it happens, and
+    to /dev/null when it is not.
     '''
     s_cmd = ' '.join(cmd)
     logger.debug("Command: '%s'", s_cmd)
 
+    if capture:
+        stdout = subprocess.PIPE
+    elif logger.isEnabledFor(logging.DEBUG):
+        stdout = None
+    else:
+        stdout = subprocess.DEVNULL
+
+    # None of the commands read input, so don't hand them a pipe or the
+    # terminal
     output = subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
+                              stdin=subprocess.DEVNULL,
+                              stdout=stdout,
                               stderr=subprocess.PIPE)
     tup_output = output.communicate()
+    cmd_output = (tup_output[0] or b'').decode('utf-8', 'replace')
 
     if output.returncode != 0:
         logger.debug('Command failed with code %d', output.returncode)
     else:
         logger.debug('Command succeeded with code %d', output.returncode)
 
-    if tup_output[0].strip():
-        logger.debug('Output for "%s":\n%s', s_cmd, tup_output[0])
+    if cmd_output.strip():
+        logger.debug('Output for "%s":\n%s', s_cmd, cmd_output)
 
     if not hide_error and 0 != output.returncode:
-        logger.error('Error output for "%s":\n%s', s_cmd, tup_output[1])
+        logger.error('Error output for "%s":\n%s', s_cmd,
+                     tup_output[1].decode('utf-8', 'replace'))
         if not cont_on_error:
             raise AbortScriptException(
                 "Command '{0}' failed with return code {1}".format(
                     s_cmd, output.returncode))
         logger.debug('Continuing despite error %d', output.returncode)
 
-    return tup_output[0]
+    return cmd_output
+
+
+def get_vm_state(vmname):
+    """Return the VirtualBox state of the given VM.
+
+    Returns None if no VM of that name is registered. This replaces separate
+    'list runningvms' and 'list vms' queries with a single targeted one.
+    """
+    output = run(['VBoxManage', 'showvminfo', vmname, '--machinereadable'],
+                 hide_error=True, capture=True)
+    match = re.search(r'^VMState="(.*)"', output, re.MULTILINE)
+    if not match:
+        return None
+    return match.group(1)
+
+
+def vm_is_running(state):
+    """Return True if the VM state still needs a poweroff to stop it."""
+    return state is not None and state not in VM_STOPPED_STATES
 
 
 def cleanup_vmname(vmname, delete=False):
@@ -133,43 +213,44 @@ def cleanup_vmname(vmname, delete=False):
     If delete is True, also unregister and delete the VM.
     """
     # Power off VM if it is running
-    vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-    if re.search('"' + vmname + '"', vms_list_running):
-        logger.debug("'%s' is running, powering off...", vmname)
+    state = get_vm_state(vmname)
+    if vm_is_running(state):
+        logger.debug("'%s' is %s, powering off...", vmname, state)
         run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
 
         logger.debug('Waiting for machine to shutdown')
 
         elapsed_time = 0
+        delay = SHUTDOWN_POLL_INTERVAL
         while True:
-            vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-            if not re.search('"' + vmname + '"', vms_list_running):
+            state = get_vm_state(vmname)
+            if not vm_is_running(state):
                 logger.debug('Successfully shut down')
                 break
             elif elapsed_time < TIMEOUT:
-                logger.warning("VM is not yet stopped after %d seconds; "
-                               "sleep %d seconds and retry", elapsed_time,
-                               RETRY_INTERVAL)
-                time.sleep(RETRY_INTERVAL)
-                elapsed_time = elapsed_time + RETRY_INTERVAL
+                logger.debug("VM is not yet stopped after %d seconds; "
+                             "sleep %s seconds and retry", elapsed_time,
+                             delay)
+                time.sleep(delay)
+                elapsed_time = elapsed_time + delay
+                delay = min(delay * 2, RETRY_INTERVAL)
                 continue
             else:
                 # Dump verbose output in case it helps...
-                run(['VBoxManage', 'showvminfo', vmname])
+                if logger.isEnabledFor(logging.DEBUG):
+                    run(['VBoxManage', 'showvminfo', vmname])
                 raise AbortScriptException(
                     "VM still not stopped after {0} seconds!"
                     .format(elapsed_time))
 
-    if delete:
-        vms_list = run(['VBoxManage', 'list', 'vms'])
-        if re.search('"' + vmname + '"', vms_list):
-            logger.debug("'%s' is registered, unregistering and deleting it",
-                         vmname)
-            run(['VBoxManage', 'unregistervm', vmname, '--delete'])
+    if delete and state is not None:
+        logger.debug("'%s' is registered, unregistering and deleting it",
+                     vmname)
+        run(['VBoxManage', 'unregistervm', vmname, '--delete'])
 
 def cleanup_vdi(vdi, delete=True):
     """Unregister and delete the given VirtualBox virtual disk."""
-    vdi_list = run(['VBoxManage', 'list', 'hdds'])
+    vdi_list = run(['VBoxManage', 'list', 'hdds'], capture=True)
     # Example output:
     # UUID:           c72cca30-1c24-436e-90ac-66237700eed6
     # Parent UUID:    base
@@ -180,28 +261,55 @@ def cleanup_vdi(vdi, delete=True):
     # Capacity:       46080 MBytes
     # Encryption:     disabled
 
-    if vdi not in vdi_list:
+    # Map each registered disk's location to its UUID, so the VDI is
+    # matched on its exact path rather than a substring of the listing
+    uuids = {}
+    for block in vdi_list.split('\n\n'):
+        fields = {}
+        for line in block.splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                fields[key.strip()] = value.strip()
+        if 'UUID' in fields and 'Location' in fields:
+            uuids[fields['Location']] = fields['UUID']
+
+    uuid = uuids.get(vdi)
+    if uuid is None:
         logger.info("VDI '%s' is not currently registered. "
                     "No cleanup needed.", vdi)
         return
 
-    # Else, we have to get the UUID associated with this vdi file
-    pattern = (r"^UUID: *([-a-fA-F0-9]+) *$(?:\n^.+:.*$)*\n^Location: *{0}"
-               .format(vdi))
-    match = re.search(pattern, vdi_list)
-    if not match:
-        raise AbortScriptException(
-            "VDI %s is in the hdds list, but couldn't identify its UUID!")
-
-    uuid = match.group(1)
     logger.info("Deleting stale VDI %s (UUID %s)", vdi, uuid)
     run(['VBoxManage', 'closemedium', 'disk', uuid, '--delete'])
 
+
+def remove_file(path):
+    """Delete path if it exists, returning True if it did."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_stale_ssh_entries():
+    """Remove known_hosts entries left over from previous boxes."""
+    # Nothing can be stale without a known_hosts file, and ssh-keygen
+    # fails rather than doing nothing if it is missing
+    if not os.path.isfile(KNOWN_HOSTS):
+        logger.debug('No known_hosts file, so no stale SSH entries')
+        return
+
+    # ssh-keygen handles hashed entries, which a plain line filter can't
+    run(['ssh-keygen', '-R', '[localhost]:2222'])
+    run(['ssh-keygen', '-R', '[localhost]:2223'])
+
+
 def pause_to_debug():
     """Pause the script for manual debugging of the VM before continuing."""
     print("Pause before debug")
     print("Use: 'socat TCP:localhost:65000 -,raw,echo=0,escape=0x1d' to access the VM")
-    raw_input("Press Enter to continue.")
+    input("Press Enter to continue.")
     # To debug post box creation, add the following lines to Vagrantfile
     # config.vm.provider "virtualbox" do |v|
     #   v.customize ["modifyvm", :id, "--uart1", "0x3F8", 4, "--uartmode1", 'tcpserver', 65005]
@@ -214,64 +322,100 @@ def start_process(args):
     Start vboxheadless process
     '''
     logger.debug('args: %s', args)
-    with open(os.devnull, 'w') as fp:
-        subprocess.Popen((args), stdout=fp)
-    time.sleep(2)
+    subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL)
+
+
+def wait_for_console(port, timeout=TIMEOUT):
+    """Wait for the VM's serial tcpserver port to accept connections.
+
+    VirtualBox only opens the port once the VM is powered on, so this is a
+    cheaper readiness check than polling VBoxManage.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(('localhost', port),
+                                            STARTUP_POLL_INTERVAL)
+        except socket.error:
+            if time.time() >= deadline:
+                raise AbortScriptException(
+                    "VM console port {0} still not listening after {1} "
+                    "seconds!".format(port, timeout))
+            time.sleep(STARTUP_POLL_INTERVAL)
+        else:
+            sock.close()
+            return
 
 
 def configure_xr(verbosity):
     """Bring up XR and do some initial config.
 
-    Uses socat to do the connection as telnet has an
-    odd double return on vbox.
+    Talks to the serial tcpserver port directly over a socket, rather
+    than through telnet (which has an odd double return on vbox) or a
+    socat child process.
     """
     logger.info('Logging into Vagrant Virtualbox and configuring IOS XR')
 
     localhost = 'localhost'
-    prompt = r"ios[$#]$"
+    # Compiled once, as it is matched after nearly every line sent
+    prompt = re.compile(r"ios[$#]$")
 
     def xr_cli_wait_for_output(command, pattern):
         """Execute a XR CLI command and try to find a pattern.
 
-        Try up to five times, waiting RETRY_INTERVAL between each try,
-        then register an error.
+        Keep re-issuing the command until the pattern shows up or
+        XR_CLI_WAIT_TIMEOUT expires, then register an error.
         """
-        total = 5
-        found_match = False
+        regex = re.compile(pattern)
+        deadline = time.time() + XR_CLI_WAIT_TIMEOUT
+        attempt = 0
 
-        for attempt in range(total):
+        while True:
+            attempt += 1
             try:
                 logger.debug("Looking for '%s' in output of '%s'",
                              pattern, command)
                 child.sendline(command)
                 child.expect(prompt)
-                if re.search(pattern, child.before):
-                    found_match = True
+                if regex.search(child.before):
                     logger.debug("Found '%s' in '%s'", pattern, command)
-                    break
-                logger.debug("No match found; sleeping %d before retrying",
-                             RETRY_INTERVAL)
-                time.sleep(RETRY_INTERVAL)
+                    return
             except pexpect.TIMEOUT:
                 logger.warning("Timed out without returning to prompt. "
                                "The device may be in a bad state now.")
-            logger.debug("Iteration '%s' out of '%s'", (attempt + 1), total)
 
-        if not found_match:
-            raise Exception("No '%s' in '%s'" % (pattern, command))
+            if time.time() >= deadline:
+                raise Exception("No '%s' in '%s' after %d attempts" %
+                                (pattern, command, attempt))
+            logger.debug("No match found on attempt %d; sleeping %d "
+                         "before retrying", attempt, XR_CLI_POLL_INTERVAL)
+            time.sleep(XR_CLI_POLL_INTERVAL)
 
+    child = None
     try:
-        child = pexpect.spawn("socat TCP:%s:%s -,raw,echo=0,escape=0x1d" %
-                              (localhost, CONSOLE_PORT))
-
+        sock = socket.create_connection((localhost, CONSOLE_PORT))
+        # Config lines are small writes; send them without Nagle delays
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Hand the descriptor over to pexpect, which closes it for us.
+        # Boot logs several MB to the console, so read in large chunks
+        # rather than the default 2000 bytes.
+        child = fdpexpect.fdspawn(sock.detach(), maxread=CONSOLE_MAXREAD,
+                                  encoding='utf-8', codec_errors='replace')
+
+        # Only what the console sends back is logged; it already echoes
+        # everything we send
         if verbosity == logging.DEBUG:
-            child.logfile = sys.stdout
+            child.logfile_read = sys.stdout
 
         # Need to wait a while for full configuration, IP address, etc.
         child.timeout = TIMEOUT
 
-        # Setup username and password and log in
-        child.expect('Press RETURN to get started.', child.timeout)
+        # Setup username and password and log in. The whole boot log
+        # arrives before this prompt: a plain text search only rescans the
+        # tail of the buffer as data comes in, where a regex search would
+        # go over everything received so far each time.
+        child.expect_exact('Press RETURN to get started', child.timeout)
         child.sendline("")  # Send enter
         child.expect('Enter root-system username:', child.timeout)
         child.sendline("vagrant")
@@ -307,11 +451,14 @@ def configure_xr(verbosity):
         child.sendline("run cat /etc/build-info.txt")
         child.expect(prompt)
 
-        # Determine if the image is a crypto/k9 image or not
-        # This will be used to determine whether to configure ssh or not
-        child.sendline("bash -c rpm -qa | grep k9sec")
+        # Query the RPM database once for both packages of interest; only
+        # the matching lines come back over the console
+        child.sendline("bash -c rpm -qa | grep -e k9sec -e mgbl")
         child.expect(prompt)
         output = child.before
+
+        # Determine if the image is a crypto/k9 image or not
+        # This will be used to determine whether to configure ssh or not
         if '-k9sec' in output:
             crypto = True
             logger.debug("Crypto k9 image detected")
@@ -320,9 +467,6 @@ def configure_xr(verbosity):
             logger.debug("Non crypto k9 image detected")
 
         # Determine if the image has the MGBL package needed for gRPC
-        child.sendline("bash -c rpm -qa | grep mgbl")
-        child.expect(prompt)
-        output = child.before
         if '-mgbl' in output:
             mgbl = True
             logger.debug("MGBL package detected")
@@ -384,23 +528,23 @@ def configure_xr(verbosity):
         child.sendline("bash -c sed -i 's/PermitRootLogin no/PermitRootLogin yes/' /etc/ssh/sshd_config_operns")
         child.expect(prompt)
 
+        # Each step below is a single shell command line, so it costs one
+        # round trip on the serial console rather than one per line
+
         # Add passwordless sudo
-        child.sendline("bash -c echo '####Added by iosxr_setup to give vagrant passwordless access' | (EDITOR='tee -a' visudo)")
-        child.expect(prompt)
-        child.sendline("bash -c echo 'vagrant ALL=(ALL) NOPASSWD: ALL' | (EDITOR='tee -a' visudo)")
+        child.sendline("bash -c printf '%s\\n' '####Added by iosxr_setup to give vagrant passwordless access' 'vagrant ALL=(ALL) NOPASSWD: ALL' | (EDITOR='tee -a' visudo)")
         child.expect(prompt)
 
         # Add public key, so users can ssh without a password
         # https://github.com/purpleidea/vagrant-builder/blob/master/v6/files/ssh.sh
-        child.sendline("bash -c [ -d ~vagrant/.ssh ] || mkdir ~vagrant/.ssh")
-        child.expect(prompt)
-        child.sendline("bash -c chmod 0700 ~vagrant/.ssh")
-        child.expect(prompt)
-        child.sendline("bash -c echo 'ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eWW6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXPITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pzC6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZEnDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXzcWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ== vagrant insecure public key' > ~vagrant/.ssh/authorized_keys")
-        child.expect(prompt)
-        child.sendline("bash -c chmod 0600 ~vagrant/.ssh/authorized_keys")
-        child.expect(prompt)
-        child.sendline("bash -c chown -R vagrant:vagrant ~vagrant/.ssh/")
+        # Stream the key base64-encoded so the XR shell has nothing to
+        # re-parse or quote, and the file is written in a single pass
+        child.sendline("bash -c mkdir -p ~vagrant/.ssh"
+                       " && chmod 0700 ~vagrant/.ssh"
+                       " && echo %s | base64 -d > ~vagrant/.ssh/authorized_keys"
+                       " && chmod 0600 ~vagrant/.ssh/authorized_keys"
+                       " && chown -R vagrant:vagrant ~vagrant/.ssh/" %
+                       base64.b64encode(VAGRANT_PUBKEY.encode()).decode())
         child.expect(prompt)
         # Sanity check
         child.sendline("bash -c cat ~vagrant/.ssh/authorized_keys")
@@ -411,11 +555,7 @@ def configure_xr(verbosity):
         # This will prevent users from needing to supply another Vagrantfile or editing /etc/resolv.conf manually
         # Doing this in xrnns (run) because the syncing of /etc/netns/global-vrf/resolv.conf to
         # /etc/resolv.conf requires 'ip netns exec global-vrf bash'.
-        child.sendline("run echo '# Cisco OpenDNS IPv4 nameservers' >> /etc/resolv.conf")
-        child.expect(prompt)
-        child.sendline("run echo 'nameserver 208.67.222.222' >> /etc/resolv.conf")
-        child.expect(prompt)
-        child.sendline("run echo 'nameserver 208.67.220.220' >> /etc/resolv.conf")
+        child.sendline("run printf '%s\\n' '# Cisco OpenDNS IPv4 nameservers' 'nameserver 208.67.222.222' 'nameserver 208.67.220.220' >> /etc/resolv.conf")
         child.expect(prompt)
 
         # Start operns sshd server so vagrant ssh can access app-hosting space
@@ -443,14 +583,21 @@ def configure_xr(verbosity):
 
         logger.info("Issuing shutdown command")
         child.sendline("run shutdown -P now")
-        logger.debug('Waiting 10 seconds...')
-        time.sleep(10)
+
+        # The console session drops as soon as the VM powers off; bound the
+        # wait and let cleanup_vmname() force a poweroff if it takes longer
+        logger.debug('Waiting for the VM to power off...')
+        try:
+            child.expect(pexpect.EOF, timeout=SHUTDOWN_TIMEOUT)
+        except pexpect.TIMEOUT:
+            logger.debug('VM still up after %d seconds', SHUTDOWN_TIMEOUT)
 
     except pexpect.TIMEOUT:
         raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' % str(child.timeout))
     finally:
-        logger.info("Closing socat session")
-        child.close()
+        if child is not None:
+            logger.info("Closing console session")
+            child.close()
 
 
 def parse_args():
@@ -484,28 +631,41 @@ def define_vbox_vm(vmname, base_dir, input_iso):
     """Create and configure (but do not start) the VirtualBox VM."""
     logger.info('Creating and configuring VirtualBox VM')
 
-    # Set the RAM according to mini of full ISO
-    if 'mini' in input_iso:
+    # Set the RAM according to mini or full ISO. Only the start of a
+    # field of the file name counts, e.g. 'iosxrv-fullk9-x64.iso', so a
+    # directory in the path can't give the wrong answer.
+    flavour = re.search(r'(?:^|[-_.])(mini|full)',
+                        os.path.basename(input_iso).lower())
+    flavour = flavour.group(1) if flavour else None
+    if flavour == 'mini':
         ram = 3072
         logger.debug('%s is a mini image, RAM allocated is %s MB',
                      input_iso, ram)
-    elif 'full' in input_iso:
+    elif flavour == 'full':
         ram = 5120
         logger.debug('%s is a full image, RAM allocated is %s MB',
                      input_iso, ram)
     else:
         sys.exit('%s is neither a mini nor a full image. Abort' % input_iso)
 
-    version = run(['VBoxManage', '-v'])
-    logger.debug('Virtual Box Manager Version: %s', version)
+    # Removing stale SSH entries, the version probe and creating the HDD
+    # don't touch the VM's settings, so run them in the background while
+    # the old VM is cleaned up and the new one is defined. Everything that
+    # modifies the VM itself stays serialized, as VBoxManage holds the
+    # machine lock for the duration of each call.
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    logger.debug('Removing stale SSH entries')
+    stale_ssh = executor.submit(remove_stale_ssh_entries)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        version = executor.submit(run, ['VBoxManage', '-v'], capture=True)
 
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
     logger.debug('base_dir: %s', base_dir)
 
+    # Creates base_dir as well, if needed
     box_dir = os.path.join(base_dir, vmname)
-    if not os.path.exists(box_dir):
-        os.makedirs(box_dir)
+    os.makedirs(box_dir, exist_ok=True)
     logger.debug('box_dir:  %s', box_dir)
 
     vbox = os.path.join(box_dir, vmname + '.vbox')
@@ -517,20 +677,23 @@ def define_vbox_vm(vmname, base_dir, input_iso):
     cleanup_vmname(vmname, delete=True)
     cleanup_vdi(vdi, delete=True)
 
-    if os.path.exists(vbox):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Virtual Box Manager Version: %s', version.result())
+
+    if remove_file(vbox):
         # Shouldn't happen if cleanup was successful, but be safe
-        logger.warning("Stale vbox %s detected. Removing it.", vbox)
-        os.remove(vbox)
+        logger.warning("Stale vbox %s detected and removed.", vbox)
 
-    if os.path.exists(vdi):
+    if remove_file(vdi):
         # Ditto failsafe
-        logger.warning("Stale vdi %s detected. Removing it.", vdi)
-        os.remove(vdi)
+        logger.warning("Stale vdi %s detected and removed.", vdi)
 
-    # Remove stale SSH entry
-    logger.debug('Removing stale SSH entries')
-    run(['ssh-keygen', '-R', '[localhost]:2222'])
-    run(['ssh-keygen', '-R', '[localhost]:2223'])
+    # Only once any stale VDI has been cleaned up. The disk is dynamically
+    # allocated (Standard variant), so only what XR writes takes up space.
+    logger.debug('Create a HDD')
+    create_hdd = executor.submit(
+        run, ['VBoxManage', 'createmedium', 'disk', '--filename', vdi,
+              '--size', '46080', '--format', 'VDI', '--variant', 'Standard'])
 
     # Create and register a new VirtualBox VM
     logger.debug('Create VM')
@@ -540,26 +703,23 @@ def define_vbox_vm(vmname, base_dir, input_iso):
     logger.debug('Register VM')
     run(['VBoxManage', 'registervm', vbox])
 
-    # Setup memory, display, cpus etc
-    logger.debug('VRAM 12')
-    run(['VBoxManage', 'modifyvm', vmname, '--vram', '12'])
-
-    logger.debug('Add ACPI')
-    run(['VBoxManage', 'modifyvm', vmname, '--memory', str(ram),
-         '--acpi', 'on'])
+    # All of the VM settings below are applied with a single modifyvm, as
+    # each VBoxManage call pays for its own startup and settings save.
+    modifyvm = ['VBoxManage', 'modifyvm', vmname]
 
-    logger.debug('Add two CPUs')
-    run(['VBoxManage', 'modifyvm', vmname, '--cpus', '2'])
+    # Setup memory, display, cpus etc
+    logger.debug('VRAM 12, %s MB RAM, ACPI and two CPUs', ram)
+    modifyvm += ['--vram', '12', '--memory', str(ram), '--acpi', 'on',
+                 '--cpus', '2']
 
     # Setup networking - including ssh
     logger.debug('Create eight NICs')
     for i in range(1, 9):
-        run(['VBoxManage', 'modifyvm', vmname,
-             '--nic' + str(i), 'nat', '--nictype' + str(i), 'virtio'])
+        modifyvm += ['--nic' + str(i), 'nat', '--nictype' + str(i), 'virtio']
 
     # logger.debug('Enable packet capture on Mgmt NIC')
-    # run(['VBoxManage', 'modifyvm', vmname, '--nictrace1', 'on',
-    #      '--nictracefile1', os.path.join(base_dir, 'Mgmt.pcap')])
+    # modifyvm += ['--nictrace1', 'on',
+    #              '--nictracefile1', os.path.join(base_dir, 'Mgmt.pcap')]
 
     # Add Serial ports
     #
@@ -585,22 +745,27 @@ def define_vbox_vm(vmname, base_dir, input_iso):
     # Option 2: Connect via socat as telnet has double echo issue)
     # But can still use telnet in conjunction with socat
     logger.debug('Add a console port')
-    run(['VBoxManage', 'modifyvm', vmname,
-         '--uart1', '0x3f8', '4', '--uartmode1', 'tcpserver',
-         str(CONSOLE_PORT)])
+    modifyvm += ['--uart1', '0x3f8', '4', '--uartmode1', 'tcpserver',
+                 str(CONSOLE_PORT)]
 
     logger.debug('Add an aux port')
-    run(['VBoxManage', 'modifyvm', vmname,
-         '--uart2', '0x2f8', '3', '--uartmode2', 'tcpserver',
-         str(AUX_PORT)])
+    modifyvm += ['--uart2', '0x2f8', '3', '--uartmode2', 'tcpserver',
+                 str(AUX_PORT)]
 
     # Option 3: Connect via telnet
     # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 tcpserver 6000
     # VBoxManage modifyvm $VMNAME --uart2 0x2f8 3 --uartmode2 tcpserver 6001
 
-    # Setup storage
-    logger.debug('Create a HDD')
-    run(['VBoxManage', 'createhd', '--filename', vdi, '--size', '46080'])
+    # Change boot order to hd then dvd
+    logger.debug('Boot order disk first, DVD second')
+    modifyvm += ['--boot1', 'disk', '--boot2', 'dvd']
+
+    run(modifyvm)
+
+    # Setup storage, once the HDD exists
+    stale_ssh.result()
+    create_hdd.result()
+    executor.shutdown()
 
     logger.debug('Add IDE Controller')
     run(['VBoxManage', 'storagectl', vmname,
@@ -611,19 +776,14 @@ def define_vbox_vm(vmname, base_dir, input_iso):
          '--storagectl', 'IDE_Controller', '--port', '0', '--device', '0',
          '--type', 'hdd', '--medium', vdi])
 
-    logger.debug('VM HD info: ')
-    run(['VBoxManage', 'showhdinfo', vdi])
+    # Purely informational, so only pay for it when it will be shown
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('VM HD info: ')
+        run(['VBoxManage', 'showhdinfo', vdi])
 
     logger.debug('Add DVD drive')
     run(['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller', '--port', '1', '--device', '0', '--type', 'dvddrive', '--medium', input_iso])
 
-    # Change boot order to hd then dvd
-    logger.debug('Boot order disk first')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot1', 'disk'])
-
-    logger.debug('Boot order DVD second')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot2', 'dvd'])
-
     return vbox
 
 def live_config_vbox_vm(vmname, box_dir, verbose, debug=False):
@@ -632,25 +792,14 @@ def live_config_vbox_vm(vmname, box_dir, verbose, debug=False):
     logger.debug('Starting VM...')
     start_process(['VBoxHeadless', '--startvm', vmname])
 
-    elapsed_time = 0
-    while True:
-        vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-        if re.search('"' + vmname + '"', vms_list_running):
-            logger.debug('Successfully started to boot VM disk image')
-            break
-        elif elapsed_time < TIMEOUT:
-            logger.warning("VM is not yet running after %d seconds; "
-                           "sleep %d seconds and retry", elapsed_time,
-                           RETRY_INTERVAL)
-            time.sleep(RETRY_INTERVAL)
-            elapsed_time = elapsed_time + RETRY_INTERVAL
-            continue
-        else:
-            # Dump verbose output in case it helps...
+    try:
+        wait_for_console(CONSOLE_PORT)
+    except AbortScriptException:
+        # Dump verbose output in case it helps...
+        if logger.isEnabledFor(logging.DEBUG):
             run(['VBoxManage', 'showvminfo', vmname])
-            raise AbortScriptException(
-                "VM still not running after {0} seconds!"
-                .format(elapsed_time))
+        raise
+    logger.debug('Successfully started to boot VM disk image')
 
     # Configure IOS XR and IOS XR Linux
     configure_xr(verbose)
@@ -664,8 +813,7 @@ def live_config_vbox_vm(vmname, box_dir, verbose, debug=False):
 
     # Disable uart before exporting
     logger.debug('Remove serial uarts before exporting')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart1', 'off'])
-    run(['VBoxManage', 'modifyvm', vmname, '--uart2', 'off'])
+    run(['VBoxManage', 'modifyvm', vmname, '--uart1', 'off', '--uart2', 'off'])
 
     # Shrink the VM
     logger.debug('Compact VDI')
@@ -677,31 +825,29 @@ def vbox_to_vagrant(vmname, box_dir):
     """Package the VirtualBox .vbox into a Vagrant .box."""
     box_out = os.path.join(box_dir, vmname + '.box')
     # Delete existing Box
-    if os.path.exists(box_out):
-        os.remove(box_out)
+    if remove_file(box_out):
         logger.debug('Found and deleted previous %s', box_out)
 
     logger.info("Generating Vagrant VirtualBox")
 
     # Add in embedded Vagrantfile
-    pathname = os.path.abspath(os.path.dirname(sys.argv[0]))
-    vagrantfile_pathname = os.path.join(
-        pathname, 'include', 'embedded_vagrantfile')
-
     run(['vagrant', 'package', '--base', vmname,
-         '--vagrantfile', vagrantfile_pathname, '--output', box_out])
+         '--vagrantfile', EMBEDDED_VAGRANTFILE, '--output', box_out])
 
     # Delete existing temporary file
     box_tmp = os.path.join(box_dir, vmname)
-    if os.path.exists(box_tmp):
-        os.remove(box_tmp)
+    if remove_file(box_tmp):
         logger.debug('Found and deleted previous %s', box_tmp)
 
+    # Recompressing the multi-GB box is CPU bound, so use pigz, which
+    # takes the same options as gzip, to spread it over all cores
+    gzip = 'pigz' if shutil.which('pigz') is not None else 'gzip'
+
     logger.info("Adding metadata.json to final box")
-    run(['gunzip', '--force', '-S', '.box', box_out])
+    run([gzip, '--decompress', '--force', '-S', '.box', box_out])
     with tarfile.open(box_tmp, 'a') as tarf:
-        tarf.add(os.path.join(pathname, "metadata.json"))
-    run(['gzip', '--force', '-S', '.box', box_tmp])
+        tarf.add(METADATA_JSON)
+    run([gzip, '--force', '-S', '.box', box_tmp])
     # gzip automatically cleans up - no need for os.remove(box_tmp)
 
     logger.info('Created: %s', box_out)
@@ -713,8 +859,7 @@ def vbox_to_ova(vmname, box_dir):
     ova_out = os.path.join(box_dir, vmname + '.ova')
 
     # Delete existing OVA
-    if os.path.exists(ova_out):
-        os.remove(ova_out)
+    if remove_file(ova_out):
         logger.debug('Found and deleted previous %s', ova_out)
 
     logger.info('Creating OVA %s', ova_out)
@@ -722,6 +867,40 @@ def vbox_to_ova(vmname, box_dir):
     logger.debug('Created OVA %s', ova_out)
 
 
+def check_required_tools(tools):
+    """Exit with a clear message if any of the given tools is not in PATH."""
+    missing = [tool for tool in tools if shutil.which(tool) is None]
+    if missing:
+        sys.exit('Required tools not found in PATH: %s' % ', '.join(missing))
+
+
+def fetch_remote_iso(uri):
+    """Copy a remote 'server:/path/to.iso' ISO to the current directory.
+
+    Returns the local filename of the copied ISO.
+
+    rsync is preferred when installed: an interrupted copy is resumed, and
+    an unchanged ISO from a previous run is not transferred again.
+    """
+    # Only supply the local user name if the URI doesn't name a user
+    if '@' in uri.split(':', 1)[0]:
+        src = uri
+    else:
+        src = '%s@%s' % (getpass.getuser(), uri)
+    if shutil.which('rsync') is not None:
+        cmd = ['rsync', '--times', '--partial', '--inplace', '--progress',
+               src, '.']
+    else:
+        cmd = ['scp', src, '.']
+    logger.debug('Will attempt to %s the remote image to current working dir. You may be required to enter your password.', cmd[0])
+    logger.debug('%s\n', ' '.join(cmd))
+    # An interrupted rsync leaves a partial ISO behind for the next run to
+    # resume, so its presence alone doesn't mean the copy worked
+    if subprocess.call(cmd) != 0:
+        sys.exit('Failed to copy %s' % uri)
+    return os.path.basename(uri)
+
+
 def main():
     """Main function."""
     input_iso = ''
@@ -729,14 +908,23 @@ def main():
 
     args = parse_args()
 
+    # A remote ISO is given as [user@]server:/path/to.iso
+    remote_iso = ':/' in args.ISO_FILE
+
+    # Fail fast, rather than part way through building the box
+    required_tools = list(REQUIRED_TOOLS)
+    if remote_iso and shutil.which('rsync') is None:
+        required_tools.append('scp')
+    if shutil.which('pigz') is None:
+        required_tools.append('gzip')
+    if os.path.isfile(KNOWN_HOSTS):
+        required_tools.append('ssh-keygen')
+    check_required_tools(required_tools)
+
     # Handle Input ISO (Local or URI)
-    if re.search(':/', args.ISO_FILE):
+    if remote_iso:
         # URI Image
-        cmd_string = 'scp %s@%s .' % (getpass.getuser(), args.ISO_FILE)
-        logger.debug('Will attempt to scp the remote image to current working dir. You may be required to enter your password.')
-        logger.debug('%s\n', cmd_string)
-        subprocess.call(cmd_string, shell=True)
-        input_iso = os.path.basename(args.ISO_FILE)
+        input_iso = fetch_remote_iso(args.ISO_FILE)
     else:
         # Local image
         input_iso = args.ISO_FILE
@@ -764,34 +952,44 @@ def main():
 
     box_dir = os.path.dirname(vbox)
 
-    try:
-        live_config_vbox_vm(vmname, box_dir, args.verbose, args.debug)
-
-        box_out = vbox_to_vagrant(vmname, box_dir)
-
-        # Create OVA
-        if create_ova is True:
-            vbox_to_ova(vmname, box_dir)
-    except:
-        if args.debug:
-            print("Exception caught:")
-            print(sys.exc_info())
-            pause_to_debug()
-        # Continue with exception handling
-        raise
-    finally:
-        # Attempt to clean up after ourselves even if something went wrong
-        cleanup_vmname(vmname, delete=True)
-
-    # Run basic sanity tests unless -s
-    if not args.skip_test:
-        logger.info('Running basic unit tests on Vagrant VirtualBox...')
-
-        # hackety hack hack hack...
-        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-        from iosxr_test import main as test_main
-        test_main(box_out, args.verbose, args.debug)
+    test_future = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            live_config_vbox_vm(vmname, box_dir, args.verbose, args.debug)
+
+            box_out = vbox_to_vagrant(vmname, box_dir)
+
+            # Run basic sanity tests unless -s. They only use the packaged
+            # box, so they go ahead while the OVA is exported from the
+            # build VM.
+            if not args.skip_test:
+                logger.info('Running basic unit tests on Vagrant VirtualBox...')
+
+                # hackety hack hack hack...
+                sys.path.append(SCRIPT_DIR)
+
+                from iosxr_test import main as test_main
+                test_future = executor.submit(test_main, box_out,
+                                              args.verbose, args.debug)
+
+            # Create OVA
+            if create_ova is True:
+                vbox_to_ova(vmname, box_dir)
+        except:
+            if args.debug:
+                print("Exception caught:")
+                print(sys.exc_info())
+                pause_to_debug()
+            # Continue with exception handling
+            raise
+        finally:
+            # Attempt to clean up after ourselves even if something went
+            # wrong
+            cleanup_vmname(vmname, delete=True)
+
+        # A test failure is raised here, once the build VM is gone
+        if test_future is not None:
+            test_future.result()
 
     logger.info('Single node use:')
     logger.info(" vagrant init 'IOS XRv'")
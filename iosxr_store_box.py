@@ -47,12 +47,12 @@ def generate_hash(file):
     global hash_file
     # SHA256 the box file and store in same location
     sha256_hash = hashlib.sha256(open(file, 'rb').read()).hexdigest()
-    logger.debug('SHA256: %s' % sha256_hash)
+    logger.debug('SHA256: %s', sha256_hash)
     hash_file = os.path.basename(file) + '.sha256.txt'
     f = open(hash_file, 'w')
     f.write(sha256_hash)
     f.close()
-    logger.debug('Hash file is %s' % hash_file)
+    logger.debug('Hash file is %s', hash_file)
 
 
 def main(argv):
@@ -116,7 +116,7 @@ def main(argv):
     parser.add_argument('-t', '--test_only', action='store_true',
                         help='test only, do not store the box or send an email')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     input_box = args.BOX_FILE
     if args.message is None:
@@ -137,13 +137,13 @@ def main(argv):
 
     logger.setLevel(level=args.verbose)
 
-    logger.debug("Input box is: '%s'" % input_box)
-    logger.debug("Message is:   '%s'" % message)
-    logger.debug("Sender is:    '%s'" % sender)
-    logger.debug("Receiver is:  '%s'" % receiver)
-    logger.debug("Release is:   '%s'" % artifactory_release)
-    logger.debug("Test Only is: '%s'" % test_only)
-    logger.debug("Sub dir is:   '%s'" % subdir)
+    logger.debug("Input box is: '%s'", input_box)
+    logger.debug("Message is:   '%s'", message)
+    logger.debug("Sender is:    '%s'", sender)
+    logger.debug("Receiver is:  '%s'", receiver)
+    logger.debug("Release is:   '%s'", artifactory_release)
+    logger.debug("Test Only is: '%s'", test_only)
+    logger.debug("Sub dir is:   '%s'", subdir)
 
     '''
     Copy the box to artifactory. This will most likely change to Atlas, or maybe both.
@@ -166,13 +166,13 @@ def main(argv):
     hash_out = os.path.join(location, subdir, os.path.basename(hash_file))
 
     if test_only is True:
-        logger.debug('Test only: copying %s to %s' % (input_box, box_out))
-        logger.debug('Test only: copying %s to %s' % (hash_file, hash_out))
+        logger.debug('Test only: copying %s to %s', input_box, box_out)
+        logger.debug('Test only: copying %s to %s', hash_file, hash_out)
     else:
         # Copy to artifactory
-        logger.debug('Copying %s to %s' % (input_box, box_out))
+        logger.debug('Copying %s to %s', input_box, box_out)
         run(['curl', '-X', 'PUT', '-u', artifactory_username + ':' + artifactory_password, '-T', input_box, box_out, '--progress-bar'])
-        logger.debug('Copying %s to %s' % (hash_file, hash_out))
+        logger.debug('Copying %s to %s', hash_file, hash_out)
         run(['curl', '-X', 'PUT', '-u', artifactory_username + ':' + artifactory_password, '-T', hash_file, hash_out])
 
     # Format an email message and send to the interest list
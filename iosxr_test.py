@@ -17,11 +17,10 @@ python iosxr_test.py iosxrv-fullk9-x64.box
 from __future__ import print_function
 import pexpect
 from pexpect import pxssh
-import subprocess
 import argparse
 import os
 import sys
-from iosxr_iso2vbox import set_logging, run, AbortScriptException
+from iosxr_iso2vbox import set_logging, run, remove_file, AbortScriptException
 import logging
 
 logger = logging.getLogger(__name__)
@@ -51,7 +50,7 @@ def check_result(result, success_message):
     Accepts a success message.
     '''
     if result == 0:
-        logger.debug('Test passed: %s' % success_message)
+        logger.debug('Test passed: %s', success_message)
         return True
     elif result == 1:
         logger.warning('EOF - Test failed')
@@ -70,34 +69,30 @@ def bringup_vagrant():
     '''
 
     # Clean up Vagrantfile
-    try:
-        os.remove('Vagrantfile')
-    except OSError:
-        pass
+    remove_file('Vagrantfile')
 
     global iosxr_port
     global linux_port
 
     # Use vagrant to init, add and bring up the inputted Vagrant VirtualBox
-    logger.debug("Bringing up '%s'..." % input_box)
+    logger.debug("Bringing up '%s'...", input_box)
 
     logger.debug('vagrant init XRv64-test')
-    output = run(['vagrant', 'init', 'XRv64-test'])
-    logger.debug(output)
+    run(['vagrant', 'init', 'XRv64-test'])
 
-    logger.debug('vagrant box add --name XRv64-test %s --force' % input_box)
-    output = run(['vagrant', 'box', 'add', '--name', 'XRv64-test', input_box, '--force'])
-    logger.debug(output)
+    logger.debug('vagrant box add --name XRv64-test %s --force', input_box)
+    run(['vagrant', 'box', 'add', '--name', 'XRv64-test', input_box, '--force'])
 
     logger.debug('vagrant up')
-    output = run(['vagrant', 'up'])
-    logger.debug(output)
+    run(['vagrant', 'up'])
 
     # Find the ports to connect to linux and xr
-    linux_port = subprocess.check_output('vagrant port --guest 57722', shell=True)
-    iosxr_port = subprocess.check_output('vagrant port --guest 22', shell=True)
+    linux_port = run(['vagrant', 'port', '--guest', '57722'],
+                     capture=True).strip()
+    iosxr_port = run(['vagrant', 'port', '--guest', '22'],
+                     capture=True).strip()
 
-    logger.debug('Connecting to port %s' % linux_port)
+    logger.debug('Connecting to port %s', linux_port)
 
     try:
         s = pxssh.pxssh(options={
@@ -106,7 +101,7 @@ def bringup_vagrant():
         s.login(hostname, username, password, terminal_type, linux_prompt, login_timeout, linux_port)
         logger.debug('Sucessfully brought up VM and logged in')
         s.logout()
-    except pxssh.ExceptionPxssh, e:
+    except pxssh.ExceptionPxssh as e:
         logger.error("pxssh failed on login")
         logger.error(e)
 
@@ -119,7 +114,7 @@ def test_linux():
     Verify resolv.conf is populated.
     '''
     logger.debug('Testing XR Linux...')
-    logger.debug('Connecting to port %s' % linux_port)
+    logger.debug('Connecting to port %s', linux_port)
 
     try:
         s = pxssh.pxssh(options={
@@ -187,7 +182,7 @@ def test_xr():
         return True
 
     logger.debug('Testing XR Console...')
-    logger.debug('Connecting to port %s' % iosxr_port)
+    logger.debug('Connecting to port %s', iosxr_port)
 
     try:
         s = pxssh.pxssh(options={
@@ -239,13 +234,13 @@ def cleanup_vagrant():
     """Clean up after ourselves."""
     logger.info("Cleaning up...")
 
-    run(['vagrant', 'destroy', '--force'], cont_on_error=True)
+    # Without a Vagrantfile there is nothing vagrant could destroy, e.g.
+    # when bringup failed before 'vagrant init'
+    if os.path.exists('Vagrantfile'):
+        run(['vagrant', 'destroy', '--force'], cont_on_error=True)
 
     # Clean up Vagrantfile
-    try:
-        os.remove('Vagrantfile')
-    except OSError:
-        pass
+    remove_file('Vagrantfile')
 
 def parse_args():
     """Parse the CLI arguments."""
@@ -307,7 +302,7 @@ def main(vbox=None, verbosity=logging.INFO, debug=False):
         # Test IOS XR Console
         result_xr = test_xr()
 
-        logger.debug('result_linux=%s, result_xr=%s' % (result_linux, result_xr))
+        logger.debug('result_linux=%s, result_xr=%s', result_linux, result_xr)
 
         if not (result_linux and result_xr):
             raise AbortScriptException('Failed basic test, box is not sane')